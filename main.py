@@ -1,49 +1,128 @@
-import struct
+import hashlib
+import json
+import mmap
 import os
+import shutil
+import tempfile
+from contextlib import asynccontextmanager
 from pathlib import Path
 from subprocess import CalledProcessError
 
 import asyncio
-import aiofiles
-from fastapi import FastAPI, UploadFile
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi import FastAPI, Request, UploadFile
+from fastapi.responses import JSONResponse
+from fastapi.staticfiles import StaticFiles
 
 
-app = FastAPI()
-
-ALLOWED_MIME_TYPE = ["model/stl", "application/sla", "application/octet-stream"]
+ALLOWED_MIME_TYPE = frozenset(
+    {"model/stl", "application/sla", "application/octet-stream"}
+)
+STATIC_DIR = "static"
 UPLOADS_DIR = Path("uploads")
 UPLOADS_DIR.mkdir(exist_ok=True)
+CACHE_DIR = Path("cache")
+CACHE_DIR.mkdir(exist_ok=True)
+CACHE_MAX_ENTRIES = 1000
 PRUSA_SLICER_PATH = "/usr/bin/prusa-slicer"
+SLICER_CONFIG_PATH = "slicer.ini"
+MAX_SIZE = 20 * 1024 * 1024  # 20 MiB
+MAX_REQUEST_SIZE = MAX_SIZE + 64 * 1024  # leave room for the multipart framing
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB
+STL_HEAD_SIZE = 84  # 80 byte header + 4 byte triangle count
+STL_TAIL_SIZE = 256  # enough to find "endsolid" behind trailing whitespace
+# PrusaSlicer is multi-threaded itself and os.cpu_count() ignores container CPU
+# limits, so keep the default small and let deployments raise it
+SLICER_WORKERS = int(os.environ.get("SLICER_WORKERS", "2"))
+SLICER_TIMEOUT = 15
+# How long an upload may wait for a free worker before slicing starts
+SLICER_QUEUE_TIMEOUT = 15
+SLICER_LOG_TAIL_SIZE = 4 * 1024
+PRINT_TIME_PREFIX = b"; estimated printing time (normal mode)"
+FILAMENT_USED_PREFIX = b"; filament used [cm3] = "
+
+# Cache keys cover the slicer settings too, so changing slicer.ini doesn't
+# return results sliced with the old settings. The hash is refreshed whenever
+# the file changes on disk, see _cache_key_seed().
+_slicer_config_seed = (None, None)
+
+# Bounded so that uploads wait for a free slot instead of piling up jobs
+slicer_queue = asyncio.Queue(maxsize=SLICER_WORKERS + 1)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Keep a fixed pool of workers for the lifetime of the app instead of
+    # starting a slicer for every request as soon as it arrives
+    workers = [asyncio.create_task(slicer_worker()) for _ in range(SLICER_WORKERS)]
+    yield
+    for worker in workers:
+        worker.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def limit_request_size(request: Request, call_next):
+    """Reject oversized requests before any of the body is read or spooled."""
+    try:
+        content_length = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        return JSONResponse({"error": "Invalid Content-Length"}, 400)
+
+    if content_length > MAX_REQUEST_SIZE:
+        return JSONResponse({"error": "File size too large"}, 413)
+
+    return await call_next(request)
 
 
-def is_ascii_stl(file_content: bytes) -> bool:
+def is_ascii_stl(head: bytes, tail: bytes) -> bool:
     """Check if the file is ASCII STL by inspecting the start and end."""
-    try:
-        text_content = file_content.decode("utf-8")
-        return text_content.startswith("solid") and text_content.strip().endswith(
-            "endsolid"
-        )
-    except UnicodeDecodeError:
-        return False
+    return head[:5] == b"solid" and tail.rstrip()[-8:] == b"endsolid"
 
 
-def is_binary_stl(file_content: bytes) -> bool:
+def is_binary_stl(head: bytes, size: int) -> bool:
     """Check if the file is Binary STL by inspecting the header and triangle count."""
-    if len(file_content) < 84:  # Minimum binary STL size
+    if size < 84:  # Minimum binary STL size
         return False
-    num_triangles = struct.unpack("<I", file_content[80:84])[0]
+    num_triangles = int.from_bytes(memoryview(head)[80:84], "little")
     expected_size = 84 + num_triangles * 50
-    return len(file_content) == expected_size
+    return size == expected_size
 
 
-def validate_stl(file_content: bytes) -> bool:
+def validate_stl(head: bytes, tail: bytes, size: int) -> bool:
     """Validate if the file is either ASCII or Binary STL."""
-    if is_ascii_stl(file_content):
+    # Without the "solid" prefix only the cheap binary size check can match
+    if head[:5] != b"solid":
+        return is_binary_stl(head, size)
+    # Some exporters start binary headers with "solid" too, so still try the
+    # binary size check before looking at the tail
+    if is_binary_stl(head, size):
         return True
-    elif is_binary_stl(file_content):
-        return True
-    return False
+    return is_ascii_stl(head, tail)
+
+
+class StlValidator:
+    """Validate an STL file incrementally while it is streamed in chunks.
+
+    Only the header, a short tail and the running size are kept, so memory use
+    does not grow with the size of the upload.
+    """
+
+    def __init__(self):
+        self.head = b""
+        self.tail = b""
+        self.size = 0
+
+    def update(self, chunk: bytes):
+        if len(self.head) < STL_HEAD_SIZE:
+            self.head += chunk[: STL_HEAD_SIZE - len(self.head)]
+        self.tail = (self.tail + chunk[-STL_TAIL_SIZE:])[-STL_TAIL_SIZE:]
+        self.size += len(chunk)
+
+    def is_valid(self) -> bool:
+        return validate_stl(self.head, self.tail, self.size)
 
 
 @app.post("/uploadfile/")
@@ -51,216 +130,327 @@ async def create_upload_file(file: UploadFile):
     if not file:
         return JSONResponse({"error": "No file uploaded"}, 400)
 
-    if file.content_type not in ALLOWED_MIME_TYPE or not file.filename.endswith(".stl"):
+    if not file.filename.endswith(".stl") or file.content_type not in ALLOWED_MIME_TYPE:
         return JSONResponse({"error": "Not an STL file"}, 400)
 
-    if file.size is None or file.size > 20 * 10e6:
-        return JSONResponse({"error": "File size too large"}, 400)
+    # The reported size comes from the client, the real limit is enforced below
+    if file.size is not None and file.size > MAX_SIZE:
+        return JSONResponse({"error": "File size too large"}, 413)
 
-    file_content = await file.read()
+    # Give every upload its own directory, so concurrent uploads with the same
+    # filename don't overwrite each other
+    upload_dir = Path(await asyncio.to_thread(tempfile.mkdtemp, dir=UPLOADS_DIR))
+    try:
+        return await process_upload(file, upload_dir)
+    finally:
+        # slice_stl only returns once the slicer has exited, so nothing
+        # writes into the directory anymore
+        await asyncio.to_thread(shutil.rmtree, upload_dir, ignore_errors=True)
+
+
+async def process_upload(file: UploadFile, upload_dir: Path):
+    """Store, validate and slice the upload inside its own upload directory."""
+    file_path = upload_dir / "model.stl"
+    gcode_file_path = file_path.with_suffix(".gcode")
+
+    # Stream the upload to disk chunk by chunk instead of buffering it whole
+    validator = StlValidator()
+    content_hash = await asyncio.to_thread(_cache_key_seed)
+    # Once Starlette has spooled the upload to a real file the kernel can copy
+    # it for us, the chunks are then only read for validation and hashing
+    source_fd = _upload_fileno(file)
+    out_file = await asyncio.to_thread(open, file_path, "wb")
+    with out_file:
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            validator.update(chunk)
+            if validator.size > MAX_SIZE:
+                break
+            content_hash.update(chunk)
+            if source_fd is None:
+                await asyncio.to_thread(out_file.write, chunk)
+
+        if source_fd is not None and validator.size <= MAX_SIZE:
+            await asyncio.to_thread(
+                _sendfile, out_file.fileno(), source_fd, validator.size
+            )
 
-    if not validate_stl(file_content):
-        return JSONResponse({"error": "File corrupted"})
+    if validator.size > MAX_SIZE:
+        return JSONResponse({"error": "File size too large"}, 413)
 
-    safe_filename = os.path.basename(file.filename)
-    file_path = os.path.join(UPLOADS_DIR, safe_filename)
+    if not validator.is_valid():
+        return JSONResponse({"error": "File corrupted"})
 
-    async with aiofiles.open(file_path, "wb") as out_file:
-        await out_file.write(file_content)
+    # Identical uploads don't need to be sliced again
+    cache_file_path = CACHE_DIR / f"{content_hash.hexdigest()}.json"
+    metadata = await asyncio.to_thread(_read_cached_metadata, cache_file_path)
+    detail = "STL file processed, result taken from the cache."
 
-    gcode_file_path = os.path.join(UPLOADS_DIR, safe_filename.replace(".stl", ".gcode"))
-    success, error_message = await run_prusa_slicer(
-        str(file_path), str(gcode_file_path)
-    )
+    if metadata is None:
+        metadata = await slice_stl(str(file_path), str(gcode_file_path))
 
-    if not success:
-        return JSONResponse({"error": "Calculation failed"}, 500)
+        if metadata is None:
+            return JSONResponse({"error": "Calculation failed"}, 500)
 
-    metadata = await parse_gcode_for_metadata(str(gcode_file_path))
+        # Don't keep serving a result the G-code couldn't be parsed into
+        if None not in metadata.values():
+            await asyncio.to_thread(_write_cached_metadata, cache_file_path, metadata)
+        detail = "STL file processed and G-code generated."
 
     return {
         "filename": file.filename,
         "print_time": metadata["print_time"],
         "filament_used_cm3": metadata["filament_used_cm3"],
-        "detail": "STL file processed and G-code generated.",
+        "detail": detail,
     }
 
 
+def _upload_fileno(file: UploadFile):
+    """Return the descriptor of the file backing the upload, if it has one."""
+    # SpooledTemporaryFile keeps small uploads in memory, calling fileno() on
+    # those would force them to disk. Checking the private _rolled flag is
+    # deliberate, it is the same check Starlette's UploadFile._in_memory does.
+    # Unlike Starlette we fall back to the in-memory path if the flag is missing.
+    if not hasattr(os, "sendfile") or not getattr(file.file, "_rolled", False):
+        return None
+    return file.file.fileno()
+
+
+def _sendfile(out_fd: int, in_fd: int, count: int):
+    offset = 0
+    while offset < count:
+        sent = os.sendfile(out_fd, in_fd, offset, count - offset)
+        if sent == 0:
+            break
+        offset += sent
+
+
+def _cache_key_seed():
+    """Return a SHA-256 hash seeded with the current slicer.ini contents."""
+    global _slicer_config_seed
+
+    stat = os.stat(SLICER_CONFIG_PATH)
+    version = (stat.st_mtime_ns, stat.st_size)
+    cached_version, seed = _slicer_config_seed
+    if cached_version != version:
+        seed = hashlib.sha256(Path(SLICER_CONFIG_PATH).read_bytes())
+        _slicer_config_seed = (version, seed)
+    return seed.copy()
+
+
+def _read_cached_metadata(cache_file_path: Path):
+    try:
+        with open(cache_file_path, "r") as cache_file:
+            metadata = json.load(cache_file)
+    except FileNotFoundError:
+        return None
+    # Entries missing a value are treated as misses and sliced again
+    if None in metadata.values():
+        return None
+    # Mark the entry as recently used so pruning drops it last
+    try:
+        os.utime(cache_file_path)
+    except FileNotFoundError:
+        pass  # pruned in the meantime, the result we read is still fine
+    return metadata
+
+
+def _write_cached_metadata(cache_file_path: Path, metadata: dict):
+    # Write to a temporary file first so readers never see a partial entry
+    with tempfile.NamedTemporaryFile(
+        "w", dir=CACHE_DIR, suffix=".tmp", delete=False
+    ) as cache_file:
+        json.dump(metadata, cache_file)
+    os.replace(cache_file.name, cache_file_path)
+    _prune_cache()
+
+
+def _prune_cache():
+    """Drop the least recently used entries once the cache grows too large.
+
+    This also clears out entries that were keyed on an old slicer.ini.
+    """
+    entries = [
+        entry for entry in os.scandir(CACHE_DIR) if entry.name.endswith(".json")
+    ]
+    if len(entries) <= CACHE_MAX_ENTRIES:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime_ns)
+    for entry in entries[: len(entries) - CACHE_MAX_ENTRIES]:
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass  # already pruned by a concurrent request
+
+
+async def slice_stl(stl_file_path: str, gcode_file_path: str):
+    """Queue the uploaded file for slicing and wait for its G-code metadata.
+
+    Returns None if the G-code couldn't be generated or no worker took the job
+    within SLICER_QUEUE_TIMEOUT. Once this returns no slicer is using the
+    files anymore, so the caller is free to remove them.
+    """
+    future = asyncio.get_running_loop().create_future()
+    started = asyncio.Event()
+    finished = asyncio.Event()
+    job = (stl_file_path, gcode_file_path, future, started, finished)
+    try:
+        # Only the wait for a worker is bounded here, the slicing itself is
+        # bounded by the worker's SLICER_TIMEOUT
+        try:
+            async with asyncio.timeout(SLICER_QUEUE_TIMEOUT):
+                await slicer_queue.put(job)
+                await started.wait()
+        except asyncio.TimeoutError:
+            print(f"Timed out waiting for a slicer worker for {stl_file_path}")
+            return None
+
+        return await future
+    finally:
+        # If we stop waiting early this makes the worker skip or kill the job
+        future.cancel()
+        if started.is_set():
+            await finished.wait()
+
+
+async def slicer_worker():
+    """Take slicing jobs off the queue, slice them and parse the result."""
+    while True:
+        stl_file_path, gcode_file_path, future, started, finished = (
+            await slicer_queue.get()
+        )
+        # Skip jobs whose request already gave up waiting
+        if future.done():
+            slicer_queue.task_done()
+            continue
+
+        started.set()
+        task = asyncio.create_task(_slice_and_parse(stl_file_path, gcode_file_path))
+        # Stop slicing as soon as the request is no longer waiting for it
+        future.add_done_callback(lambda _, task=task: task.cancel())
+        try:
+            await asyncio.wait([task])
+            if not future.done() and not task.cancelled():
+                if task.exception() is not None:
+                    future.set_exception(task.exception())
+                else:
+                    future.set_result(task.result())
+        finally:
+            # Also reached when the worker itself is cancelled on shutdown
+            task.cancel()
+            await asyncio.wait([task])
+            finished.set()
+            slicer_queue.task_done()
+
+
+async def _slice_and_parse(stl_file_path: str, gcode_file_path: str):
+    success, error_message = await run_prusa_slicer(stl_file_path, gcode_file_path)
+    if not success:
+        return None
+    return await parse_gcode_for_metadata(gcode_file_path)
+
+
 async def run_prusa_slicer(
-    stl_file_path: str, output_file_path: str, timeout: int = 15
+    stl_file_path: str, output_file_path: str, timeout: int = SLICER_TIMEOUT
 ):
     """Run PrusaSlicer on the uploaded file asynchronously with a timeout."""
+    # Send the slicer output straight to a log file instead of buffering it in
+    # memory, it is only looked at when slicing fails
+    log_file_path = os.path.splitext(output_file_path)[0] + ".log"
     try:
-        # Run PrusaSlicer as an async subprocess and wait for it to complete within 15 seconds
-        process = await asyncio.create_subprocess_exec(
-            PRUSA_SLICER_PATH,
-            stl_file_path,
-            "--export-gcode",
-            "--output",
-            output_file_path,
-            "--load",
-            "slicer.ini",
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
+        log_file = await asyncio.to_thread(open, log_file_path, "wb")
+        with log_file:
+            process = await asyncio.create_subprocess_exec(
+                PRUSA_SLICER_PATH,
+                stl_file_path,
+                "--export-gcode",
+                "--output",
+                output_file_path,
+                "--load",
+                SLICER_CONFIG_PATH,
+                stdout=log_file,
+                stderr=asyncio.subprocess.STDOUT,
+            )
 
         # Wait for the process to complete with a timeout
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
+        try:
+            await asyncio.wait_for(process.wait(), timeout=timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            # Don't leave the slicer running when we stop waiting for it
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+            raise
 
         if process.returncode != 0:
-            raise CalledProcessError(
-                process.returncode, PRUSA_SLICER_PATH, output=stdout, stderr=stderr
-            )
+            output = await asyncio.to_thread(_read_log_tail, log_file_path)
+            raise CalledProcessError(process.returncode, PRUSA_SLICER_PATH, output)
 
         return True, ""
 
     except (asyncio.TimeoutError, CalledProcessError, Exception) as exc:
         print(exc)
+        if isinstance(exc, CalledProcessError):
+            print(exc.output.decode(errors="replace"))
         return False, "Couldnt generate gcode"
 
 
+def _read_log_tail(log_file_path: str) -> bytes:
+    with open(log_file_path, "rb") as log_file:
+        size = log_file.seek(0, os.SEEK_END)
+        log_file.seek(max(size - SLICER_LOG_TAIL_SIZE, 0))
+        return log_file.read()
+
+
 async def parse_gcode_for_metadata(gcode_file_path: str):
     """Parse the G-code file to extract print time and filament usage."""
+    # Scan the file in a single worker thread call instead of one per line
+    return await asyncio.to_thread(_scan_gcode, gcode_file_path)
+
+
+def _scan_gcode(gcode_file_path: str):
     print_time = None
     filament_used = None
 
-    async with aiofiles.open(gcode_file_path, "r") as gcode_file:
-        async for line in gcode_file:
-            if line.startswith("; estimated printing time (normal mode)"):
+    with open(gcode_file_path, "rb") as gcode_file:
+        if os.fstat(gcode_file.fileno()).st_size == 0:  # empty files can't be mapped
+            return {"print_time": print_time, "filament_used_cm3": filament_used}
+
+        # PrusaSlicer writes the summary comments near the end of the file, so
+        # searching backwards from the end only touches the last few pages
+        with mmap.mmap(gcode_file.fileno(), 0, access=mmap.ACCESS_READ) as gcode:
+            line = _rfind_gcode_line(gcode, PRINT_TIME_PREFIX)
+            if line is not None:
                 # Extract print time in seconds
-                print_time = line.strip().split("=")[1]
-            elif line.startswith("; filament used [cm3] = "):
+                print_time = line.strip().split(b"=")[1].decode()
+
+            line = _rfind_gcode_line(gcode, FILAMENT_USED_PREFIX)
+            if line is not None:
                 # Extract filament usage in meters
-                filament_used = float(line.strip().split("=")[1].strip())
+                filament_used = float(line.strip().split(b"=")[1].strip())
 
     # Return print time in seconds and filament usage in meters
     return {"print_time": print_time, "filament_used_cm3": filament_used}
 
 
-@app.get("/", response_class=HTMLResponse)
-async def index():
-    html_content = """
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>STL File Upload</title>
-        <style>
-            body {
-                font-family: Arial, sans-serif;
-                background-color: #f5f5f5;
-                padding: 20px;
-            }
-            .container {
-                max-width: 600px;
-                margin: 0 auto;
-                background-color: #fff;
-                padding: 20px;
-                border-radius: 8px;
-                box-shadow: 0px 0px 10px rgba(0, 0, 0, 0.1);
-            }
-            h1 {
-                text-align: center;
-                margin-bottom: 20px;
-            }
-            label {
-                font-size: 16px;
-                font-weight: bold;
-            }
-            input[type="file"] {
-                display: block;
-                margin: 10px 0;
-            }
-            button {
-                padding: 10px 20px;
-                background-color: #4CAF50;
-                color: white;
-                border: none;
-                border-radius: 5px;
-                cursor: pointer;
-            }
-            button:hover {
-                background-color: #45a049;
-            }
-            .output {
-                margin-top: 20px;
-            }
-            .output p {
-                padding: 10px;
-                border-radius: 5px;
-            }
-            .success {
-                background-color: #d4edda;
-                color: #155724;
-            }
-            .error {
-                background-color: #f8d7da;
-                color: #721c24;
-            }
-        </style>
-    </head>
-    <body>
-
-    <div class="container">
-        <h1>Upload STL File for Slicing</h1>
-        
-        <form id="uploadForm">
-            <label for="stlFile">Select an STL file:</label>
-            <input type="file" id="stlFile" name="stlFile" accept=".stl" required>
-            <button type="submit">Upload and Process</button>
-        </form>
-
-        <div class="output" id="output"></div>
-    </div>
-
-    <script>
-        const form = document.getElementById('uploadForm');
-        const output = document.getElementById('output');
-
-        form.addEventListener('submit', async (e) => {
-            e.preventDefault(); // Prevent the form from submitting the traditional way
-
-            const fileInput = document.getElementById('stlFile');
-            const file = fileInput.files[0];
-
-            if (!file) {
-                displayMessage("Please select a file to upload", "error");
-                return;
-            }
-
-            const formData = new FormData();
-            formData.append("file", file);
-
-            try {
-                // Send file via POST request to FastAPI backend
-                const response = await fetch("/uploadfile/", {
-                    method: "POST",
-                    body: formData,
-                });
-
-                const data = await response.json();
-
-                if (response.ok) {
-                    displayMessage(`
-                        <strong>File:</strong> ${data.filename}<br>
-                        <strong>Print Time: </strong> ${data.print_time}<br>
-                        <strong>Filament Used (cm3):</strong> ${data.filament_used_cm3}
-                    `, "success");
-                } else {
-                    displayMessage(data.error || "An error occurred while processing the file", "error");
-                }
-            } catch (err) {
-                displayMessage("Failed to upload the file. Please try again.", "error");
-            }
-        });
-
-        function displayMessage(message, type) {
-            output.innerHTML = `<p class="${type}">${message}</p>`;
-        }
-    </script>
-
-    </body>
-    </html>
-    """
-    return HTMLResponse(content=html_content)
+def _rfind_gcode_line(gcode: mmap.mmap, prefix: bytes):
+    """Return the last line starting with prefix, or None if there is none."""
+    end = len(gcode)
+    while (start := gcode.rfind(prefix, 0, end)) != -1:
+        if start == 0 or gcode[start - 1] == ord("\n"):
+            line_end = gcode.find(b"\n", start)
+            return gcode[start : line_end if line_end != -1 else len(gcode)]
+        end = start
+    return None
+
+
+# Serve the landing page as a static file so repeat visitors get ETag /
+# Last-Modified based 304 responses
+static_files = StaticFiles(directory=STATIC_DIR)
+app.mount("/static", static_files, name="static")
+
+
+@app.get("/", include_in_schema=False)
+async def index(request: Request):
+    index_path = os.path.join(STATIC_DIR, "index.html")
+    stat_result = await asyncio.to_thread(os.stat, index_path)
+    return static_files.file_response(index_path, stat_result, request.scope)